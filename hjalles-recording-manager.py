@@ -3,6 +3,7 @@ import glob
 import json
 import os
 import pathlib
+import queue
 import shutil
 import subprocess
 import threading
@@ -21,6 +22,13 @@ CURRENT_RECORDING = {
     "total_size": 0,
     "total_time": 0
 }
+THUMBNAIL_QUEUE = queue.Queue()
+THUMBNAIL_PENDING = set()
+THUMBNAIL_LOCK = threading.Lock()
+THUMBNAIL_STOP = threading.Event()
+THUMBNAIL_WORKER = None
+# Containers OBS records to
+RECORDING_FORMATS = ["mkv", "mp4", "mov", "flv", "ts"]
 
 
 def script_description():
@@ -47,9 +55,30 @@ def script_load(settings):
     obs.obs_data_set_default_int(settings, "RemuxCRF", 23)
     obs.obs_data_set_default_string(settings, "RemuxH264Preset", "medium")
 
+    obs.obs_data_set_default_int(settings, "ThumbnailInterval", 30)
+    obs.obs_data_set_default_int(settings, "ThumbnailWidth", 320)
+    obs.obs_data_set_default_int(settings, "ThumbnailSheetColumns", 6)
+
+    start_thumbnail_worker()
+
     obs.timer_add(split_file, 1000)
 
 
+def script_unload():
+    # Drop queued jobs so a reloaded script doesn't process them twice, then wake the worker so it
+    # exits after its current job instead of blocking on a queue that is discarded on reload
+    THUMBNAIL_STOP.set()
+    while True:
+        try:
+            THUMBNAIL_QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        THUMBNAIL_QUEUE.task_done()
+    with THUMBNAIL_LOCK:
+        THUMBNAIL_PENDING.clear()
+    THUMBNAIL_QUEUE.put(None)
+
+
 def script_update(settings):
     global SETTINGS, SCRIPT_PROPERTIES
 
@@ -87,6 +116,11 @@ def script_update(settings):
     SETTINGS["ManualRemuxInputFile"] = obs.obs_data_get_string(settings, "ManualRemuxInputFile")
     SETTINGS["ManualRemuxInputFolder"] = obs.obs_data_get_string(settings, "ManualRemuxInputFolder")
 
+    SETTINGS["GenerateThumbnails"] = obs.obs_data_get_bool(settings, "GenerateThumbnails")
+    SETTINGS["ThumbnailInterval"] = obs.obs_data_get_int(settings, "ThumbnailInterval")
+    SETTINGS["ThumbnailWidth"] = obs.obs_data_get_int(settings, "ThumbnailWidth")
+    SETTINGS["ThumbnailSheetColumns"] = obs.obs_data_get_int(settings, "ThumbnailSheetColumns")
+
 
 def file_sorting_modified(props, prop, settings, *args, **kwargs):
     value = obs.obs_data_get_string(settings, "RecordingSortType")
@@ -279,6 +313,209 @@ def manual_remux(props, prop, *args, **kwargs):
             thread.start()
 
 
+def get_thumbnail_dir(input_path):
+    input_file = pathlib.Path(input_path)
+    return os.path.join(input_file.parent, f".{input_file.stem}_thumbs")
+
+
+def get_thumbnail_settings(input_path):
+    global SETTINGS
+
+    stat = os.stat(input_path)
+    return {
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime,
+        "interval": max(SETTINGS["ThumbnailInterval"], 1),
+        "width": SETTINGS["ThumbnailWidth"],
+        "columns": max(SETTINGS["ThumbnailSheetColumns"], 1)
+    }
+
+
+def thumbnails_cached(input_path, thumb_settings):
+    # The manifest is written last, so it only exists for completed runs
+    manifest = os.path.join(get_thumbnail_dir(input_path), "manifest.json")
+    try:
+        with open(manifest, "r") as f:
+            return json.load(f) == thumb_settings
+    except (OSError, ValueError):
+        return False
+
+
+def clear_thumbnails(thumb_dir):
+    for file in glob.glob(os.path.join(thumb_dir, "thumb_*.jpg")) + [os.path.join(thumb_dir, "manifest.json")]:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def get_video_duration(input_path):
+    # Reads the container header only, no frames are decoded. ffprobe is optional, without it the
+    # contact sheet falls back to the thumbnail interval
+    try:
+        p = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration",
+                            "-of", "default=noprint_wrappers=1:nokey=1", input_path], capture_output=True, text=True)
+    except OSError:
+        return None
+    try:
+        return float(p.stdout.strip())
+    except ValueError:
+        return None
+
+
+def generate_thumbnail_cmd(input_path, thumb_settings):
+    thumb_dir = get_thumbnail_dir(input_path)
+    interval = thumb_settings["interval"]
+    width = thumb_settings["width"]
+    columns = thumb_settings["columns"]
+    # Spread the contact sheet samples over the whole recording so it fits on a single tile
+    duration = get_video_duration(input_path)
+    if duration:
+        sheet_rate = f"{columns ** 2}/{duration:.3f}"
+    else:
+        sheet_rate = f"1/{interval}"
+    # Only keyframes are decoded, so a single pass yields both the thumbnails and the contact sheet
+    filter_graph = (f"[0:v]split[thumbs_in][sheet_in];"
+                    f"[thumbs_in]fps=1/{interval},scale={width}:-2[thumbs];"
+                    f"[sheet_in]fps={sheet_rate},scale={width // 2}:-2,tile={columns}x{columns}[contact]")
+    thumbs_out = os.path.join(thumb_dir, "thumb_%04d.jpg")
+    sheet_out = os.path.join(thumb_dir, "contact_sheet.jpg")
+    ffmpeg_cmd = ["ffmpeg", "-y", "-skip_frame", "nokey", "-i", input_path, "-filter_complex", filter_graph,
+                  "-map", "[thumbs]", "-q:v", "4", thumbs_out,
+                  "-map", "[contact]", "-frames:v", "1", "-q:v", "4", sheet_out]
+
+    return ffmpeg_cmd
+
+
+def queue_thumbnail_job(target, *args):
+    job = (target, args)
+    with THUMBNAIL_LOCK:
+        if job in THUMBNAIL_PENDING:
+            return
+        THUMBNAIL_PENDING.add(job)
+    THUMBNAIL_QUEUE.put(job)
+
+
+def queue_thumbnails(input_path):
+    queue_thumbnail_job(generate_thumbnails, os.path.abspath(input_path))
+
+
+def queue_session_sheet(split_paths, session_dir):
+    # Jobs run in order on a single worker, so the split thumbnails exist by the time this runs
+    queue_thumbnail_job(generate_session_sheet, tuple(os.path.abspath(path) for path in split_paths), session_dir)
+
+
+def generate_thumbnails(input_path):
+    # The cache is checked when the job runs, since an earlier job may have produced it meanwhile
+    if not os.path.exists(input_path):
+        return
+    thumb_settings = get_thumbnail_settings(input_path)
+    if thumbnails_cached(input_path, thumb_settings):
+        return
+    thumb_dir = get_thumbnail_dir(input_path)
+    pathlib.Path(thumb_dir).mkdir(parents=True, exist_ok=True)
+    clear_thumbnails(thumb_dir)
+    if run_ffmpeg_low_priority(generate_thumbnail_cmd(input_path, thumb_settings)) == 0:
+        with open(os.path.join(thumb_dir, "manifest.json"), "w") as f:
+            json.dump(thumb_settings, f)
+
+
+def generate_session_sheet(split_paths, session_dir):
+    global SETTINGS
+
+    thumbs = []
+    for path in split_paths:
+        thumbs += sorted(glob.glob(os.path.join(glob.escape(get_thumbnail_dir(path)), "thumb_*.jpg")))
+    if len(thumbs) == 0:
+        return
+    columns = max(SETTINGS["ThumbnailSheetColumns"], 1)
+    width = SETTINGS["ThumbnailWidth"]
+    # Pick evenly spaced thumbnails so the sheet spans every split file of the session
+    count = min(columns ** 2, len(thumbs))
+    picked = [thumbs[i * len(thumbs) // count] for i in range(count)]
+    rows = -(-count // columns)
+    pathlib.Path(session_dir).mkdir(parents=True, exist_ok=True)
+    list_path = os.path.join(session_dir, "contact_sheet.txt")
+    with open(list_path, "w") as f:
+        for thumb in picked:
+            f.write(f"file '{thumb}'\n")
+    ffmpeg_cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path,
+                  "-vf", f"scale={width // 2}:-2,tile={columns}x{rows}", "-frames:v", "1", "-q:v", "4",
+                  os.path.join(session_dir, "contact_sheet.jpg")]
+    run_ffmpeg_low_priority(ffmpeg_cmd)
+
+
+def thumbnail_worker(thumbnail_queue, stop_event):
+    while True:
+        job = thumbnail_queue.get()
+        if job is None or stop_event.is_set():
+            thumbnail_queue.task_done()
+            return
+        target, args = job
+        try:
+            target(*args)
+        except Exception as e:
+            print(f"Thumbnail generation failed for {args[0]}: {e}")
+        finally:
+            with THUMBNAIL_LOCK:
+                THUMBNAIL_PENDING.discard(job)
+            thumbnail_queue.task_done()
+
+
+def start_thumbnail_worker():
+    global THUMBNAIL_WORKER
+
+    if THUMBNAIL_WORKER is None or not THUMBNAIL_WORKER.is_alive():
+        THUMBNAIL_WORKER = threading.Thread(target=thumbnail_worker, args=(THUMBNAIL_QUEUE, THUMBNAIL_STOP),
+                                            daemon=True)
+        THUMBNAIL_WORKER.start()
+
+
+def is_remux_output(input_path):
+    # A file is only a remux output if the source it was generated from sits next to it
+    input_file = pathlib.Path(input_path)
+    filename_format = SETTINGS["RemuxFilenameFormat"]
+    same_stem = filename_format == "%FILE%"
+    if same_stem and SETTINGS["RemuxMode"] == "standard" and input_file.suffix != f".{SETTINGS['RemuxFileContainer']}":
+        return False
+    for source in glob.glob(os.path.join(glob.escape(str(input_file.parent)), "*")):
+        source_file = pathlib.Path(source)
+        if source_file == input_file or source_file.suffix[1:] not in RECORDING_FORMATS:
+            continue
+        if same_stem and source_file.suffix == input_file.suffix:
+            continue
+        if filename_format.replace("%FILE%", source_file.stem) == input_file.stem:
+            return True
+    return False
+
+
+def get_split_manifest(concat_path):
+    concat_file = pathlib.Path(concat_path)
+    return os.path.join(concat_file.parent, f".{concat_file.stem}_splits.json")
+
+
+def find_concatenated_splits(root_dir):
+    # Split files listed in the manifest written by run_concat are covered by the concatenated file
+    split_paths = set()
+    for manifest in glob.glob(f"{glob.escape(root_dir)}/**/.*_splits.json", recursive=True):
+        try:
+            with open(manifest, "r") as f:
+                split_paths.update(os.path.abspath(path) for path in json.load(f))
+        except (OSError, ValueError):
+            continue
+    return split_paths
+
+
+def manual_thumbnails(props, prop, *args, **kwargs):
+    input_folder = SETTINGS["RecordingOutDir"]
+    # Remuxed copies and concatenated split files show the same footage
+    input_files = []
+    for ff in RECORDING_FORMATS:
+        input_files += glob.glob(f"{input_folder}/**/*.{ff}", recursive=True)
+    concatenated_splits = find_concatenated_splits(input_folder)
+    for file in sorted(input_files):
+        if not is_remux_output(file) and os.path.abspath(file) not in concatenated_splits:
+            queue_thumbnails(file)
+
+
 def find_latest_file(directory, file_ext=[], exclude=[]):
     list_of_files = glob.glob(directory + "/*") + glob.glob(directory + "/.**")
 
@@ -457,6 +694,22 @@ def remux_properties(props):
     return props
 
 
+def thumbnail_properties(props):
+    # ===== THUMBNAIL OPTIONS =====
+    thumbnail_props = obs.obs_properties_create()
+
+    obs.obs_properties_add_int_slider(thumbnail_props, "ThumbnailInterval", "Thumbnail interval (s)", 1, 600, 1)
+    obs.obs_properties_add_int_slider(thumbnail_props, "ThumbnailWidth", "Thumbnail width (px)", 64, 1280, 16)
+    obs.obs_properties_add_int_slider(thumbnail_props, "ThumbnailSheetColumns", "Contact sheet columns", 1, 12, 1)
+    obs.obs_properties_add_button(thumbnail_props, "StartManualThumbnails", "Generate for output directory",
+                                  manual_thumbnails)
+
+    thumbnail_menu = obs.obs_properties_add_group(props, "GenerateThumbnails", "Generate thumbnails and contact sheets",
+                                                  obs.OBS_GROUP_CHECKABLE, thumbnail_props)
+
+    return props
+
+
 def script_properties():
     props = obs.obs_properties_create()
 
@@ -477,6 +730,7 @@ def script_properties():
     props = file_sorting_properties(props)
     props = file_split_props(props)
     props = remux_properties(props)
+    props = thumbnail_properties(props)
 
     obs.obs_properties_apply_settings(props, SCRIPT_PROPERTIES)
 
@@ -593,9 +847,36 @@ def run_ffmpeg(ffmpeg_cmd):
     return
 
 
-def run_many_ffmpegs(ffmpeg_cmds):
-    for cmd in ffmpeg_cmds:
-        subprocess.run(cmd, shell=True)
+def run_ffmpeg_low_priority(ffmpeg_args):
+    # Started without a shell so the priority applies to ffmpeg itself
+    p = psutil.Popen(ffmpeg_args)
+    try:
+        p.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == "nt" else 10)
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        pass
+    # Stop early if the script is unloaded, a reloaded script would otherwise run the same job again
+    while True:
+        try:
+            return p.wait(timeout=1)
+        except psutil.TimeoutExpired:
+            if THUMBNAIL_STOP.is_set():
+                p.terminate()
+                p.wait()
+                return -1
+
+
+def run_concat(concat_cmd, concat_path, split_paths, remux_cmd=None, thumbnails=False):
+    p = subprocess.run(concat_cmd, shell=True)
+    if p.returncode != 0:
+        print(f"Concatenation failed (exit code {p.returncode})")
+        return
+    with open(get_split_manifest(concat_path), "w") as f:
+        json.dump([os.path.abspath(path) for path in split_paths], f)
+    # Thumbnails only need the concatenated file, so they don't wait for the remux
+    if thumbnails:
+        queue_thumbnails(concat_path)
+    if remux_cmd is not None:
+        subprocess.run(remux_cmd, shell=True)
 
 
 def on_event(event):
@@ -621,6 +902,10 @@ def on_event(event):
             output = save_recording(recording_path, new_dir)
             print(f"Saved recording -> {output}")
 
+            if SETTINGS["GenerateThumbnails"]:
+                print("Queueing thumbnail generation...")
+                queue_thumbnails(output)
+
             if SETTINGS["RemuxRecordings"]:
                 print("Remuxing recording...")
                 ffmpeg_input = output
@@ -639,11 +924,21 @@ def on_event(event):
             path = find_latest_file(obs.obs_frontend_get_current_record_output_path())
             CURRENT_RECORDING["time_splits"].append((path, datetime.datetime.now()))
             concat_str = ""
+            split_paths = []
             for split in CURRENT_RECORDING["time_splits"]:
                 path = pathlib.Path(split[0])
                 timestamp = split[1]
                 output_path = save_recording(path, split_dir, timestamp=timestamp)
                 concat_str += f"file '{output_path}'\n"
+                split_paths.append(output_path)
+                if SETTINGS["GenerateThumbnails"] and not SETTINGS["SplitConcatenate"]:
+                    queue_thumbnails(output_path)
+
+            if SETTINGS["GenerateThumbnails"] and not SETTINGS["SplitConcatenate"]:
+                session_name = end_time.strftime(SETTINGS["FilenameFormat"])
+                session_dir = os.path.join(split_dir, f".{session_name}_session_thumbs")
+                print(f"Queueing session contact sheet -> {session_dir}/")
+                queue_session_sheet(split_paths, session_dir)
 
             if SETTINGS["SplitConcatenate"]:
                 input_file = CURRENT_RECORDING["time_splits"][0][0]
@@ -653,18 +948,20 @@ def on_event(event):
                 print(f"Concatenating split files -> {concat_path}")
                 with open("concat.txt", "w") as f:
                     f.write(concat_str)
+                thumbnails = SETTINGS["GenerateThumbnails"]
 
                 if SETTINGS["RemuxRecordings"]:
                     print("Remuxing concatenated file...")
                     concat_cmd = f"ffmpeg -f concat -safe 0 -i concat.txt -c copy {concat_path}"
                     remux_cmd = generate_ffmpeg_cmd(concat_path)
-                    ffmpeg_cmds = [concat_cmd, remux_cmd]
-                    remux_thread = threading.Thread(target=run_many_ffmpegs, args=(ffmpeg_cmds,))
+                    remux_thread = threading.Thread(target=run_concat, args=(concat_cmd, concat_path, split_paths,
+                                                                             remux_cmd, thumbnails))
                     remux_thread.start()
 
                 else:
                     ffmpeg_cmd = f"ffmpeg -f concat -safe 0 -i concat.txt -c copy {concat_path}"
-                    remux_thread = threading.Thread(target=run_ffmpeg, args=(ffmpeg_cmd,))
+                    remux_thread = threading.Thread(target=run_concat, args=(ffmpeg_cmd, concat_path, split_paths,
+                                                                             None, thumbnails))
                     remux_thread.start()
 
 